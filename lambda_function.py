@@ -7,8 +7,14 @@ from decimal import Decimal
 import psycopg2
 import requests
 from bs4 import BeautifulSoup
+from lxml import etree
 from psycopg2.extras import execute_values
 
+AUM_REPORT_CHUNK_BYTES = 64 * 1024
+INSERT_CHUNK_SIZE = 500
+MC_REVISION_DAYS = 7
+PUBLISH_MARGIN_DAYS = 5
+
 
 def slugify(name: str, existing_slugs: list[str]) -> str:
     try:
@@ -107,6 +113,16 @@ def get_funds(query, id_comparison=False):
         return []
 
 
+def normalize_fund_name(name: str) -> str:
+    name = " ".join(name.encode("ascii", "ignore").decode("ascii").split())
+
+    return name.replace("FundClass", "Fund Class").casefold()
+
+
+def index_fund(names_ids: dict, id, name, category_id):
+    names_ids[(normalize_fund_name(name), category_id)] = (id, name)
+
+
 def get_funds_names_ids(query):
     try:
         query.execute(
@@ -118,7 +134,7 @@ def get_funds_names_ids(query):
             names_ids = dict()
 
             for row in result:
-                names_ids[f"{row[1]}~{row[2]}"] = row[0]
+                index_fund(names_ids, row[0], row[1], row[2])
 
             return names_ids
 
@@ -170,21 +186,33 @@ def get_categories_names_ids(query):
         return dict()
 
 
-def get_mc_codes(query):
+def get_mc_codes(query, due_only=False):
     try:
         date_2_months_ago = datetime.now(timezone.utc) - timedelta(days=90)
         date_2_months_ago = date_2_months_ago.replace(day=1).isoformat()
+        params = [date_2_months_ago]
+        due_filter = ""
+
+        if due_only:
+            # Only months still empty or recent enough to be revised by MUFAP
+            due_filter = "WHERE total IS NULL OR created_at >= %s"
+            params.append(
+                (
+                    datetime.now(timezone.utc) - timedelta(days=MC_REVISION_DAYS)
+                ).isoformat()
+            )
 
         query.execute(
-            """
+            f"""
             SELECT code
-            FROM (SELECT DISTINCT ON (fund_id) fund_id, code, month
+            FROM (SELECT DISTINCT ON (fund_id) fund_id, code, month, total, created_at
                   FROM mutual_funds_marketcap
                   WHERE month >= %s
                   ORDER BY fund_id, month DESC, code) AS t
+            {due_filter}
             ORDER BY month DESC;
             """,
-            (date_2_months_ago,),
+            params,
         )
         result = query.fetchall()
 
@@ -198,6 +226,77 @@ def get_mc_codes(query):
         return []
 
 
+def get_mc_history(query):
+    try:
+        date_1_year_ago = datetime.now(timezone.utc) - timedelta(days=365)
+        date_1_year_ago = date_1_year_ago.replace(day=1).isoformat()
+
+        query.execute(
+            "SELECT month, MIN(created_at) FROM mutual_funds_marketcap WHERE month >= %s GROUP BY month ORDER BY month;",
+            (date_1_year_ago,),
+        )
+        result = query.fetchall()
+
+        if result:
+            return [
+                (
+                    row[0].date() if isinstance(row[0], datetime) else row[0],
+                    row[1].date(),
+                )
+                for row in result
+            ]
+
+        return []
+    except Exception as e:
+        print(f"get_mc_history: {e}")
+        return []
+
+
+def add_months(date, months):
+    month_index = date.month - 1 + months
+
+    return date.replace(
+        year=date.year + month_index // 12, month=month_index % 12 + 1, day=1
+    )
+
+
+def is_funds_scrape_due(query):
+    try:
+        today = datetime.now(timezone.utc).date()
+        history = get_mc_history(query)
+
+        if not history:
+            return True
+
+        # aum_report.php lists a single month for all funds, so only the latest
+        # stored month decides what is due next
+        latest_month = history[-1][0]
+
+        # Days between each month's end and the day its report first showed up
+        lags = [
+            (created_at - add_months(month, 1)).days for month, created_at in history
+        ]
+        # Start looking a few days early so an earlier publish can lower the lag
+        next_check_date = add_months(latest_month, 2) + timedelta(
+            days=max(min(lags) - PUBLISH_MARGIN_DAYS, 0)
+        )
+
+        if today < next_check_date:
+            return False
+
+        report_month = get_report_month()
+
+        if report_month is not None and report_month <= latest_month:
+            print(f"Funds for {add_months(latest_month, 1)} not published yet")
+            return False
+
+        print(f"Funds due for {add_months(latest_month, 1)}")
+        return True
+    except Exception as e:
+        print(f"is_funds_scrape_due: {e}")
+        return True
+
+
 def get_all_mc_codes(query):
     try:
         query.execute("SELECT code FROM mutual_funds_marketcap ORDER BY id;")
@@ -213,7 +312,7 @@ def get_all_mc_codes(query):
         return []
 
 
-def add_mcs(conn=None):
+def add_mcs(conn=None, mc_codes=None):
     try:
         query = conn.cursor()
 
@@ -223,7 +322,8 @@ def add_mcs(conn=None):
         }
 
         print("Updating Market Caps...")
-        mc_codes = get_mc_codes(query)
+        if mc_codes is None:
+            mc_codes = get_mc_codes(query)
         updated_at = datetime.now(timezone.utc).isoformat()
 
         for mc_code in mc_codes:
@@ -393,6 +493,115 @@ def update_fund(query, id, name):
         print(f"update_fund: {e}")
 
 
+def element_text(element) -> str:
+    return "".join(element.itertext())
+
+
+def iter_aum_report(response):
+    parser = etree.HTMLPullParser(events=("start", "end"))
+    table_depth = 0
+
+    def read_events():
+        for chunk in response.iter_content(chunk_size=AUM_REPORT_CHUNK_BYTES):
+            parser.feed(chunk)
+            yield from parser.read_events()
+
+        parser.close()
+        yield from parser.read_events()
+
+    for event, element in read_events():
+        if element.tag == "table":
+            if event == "start" and (
+                table_depth or "mydata" in element.get("class", "").split()
+            ):
+                table_depth += 1
+            elif event == "end" and table_depth:
+                table_depth -= 1
+
+            continue
+
+        if event != "end":
+            continue
+
+        if element.tag == "option" or (element.tag == "tr" and table_depth):
+            yield element
+
+            # Drop the parsed row and everything before it so the tree never
+            # holds more than the row currently being read.
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def get_report_month():
+    try:
+        URL = "https://www.mufap.com.pk/aum_report.php"
+        HEADERS = {
+            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"
+        }
+        params = {"tab": "01"}
+
+        with requests.get(
+            url=URL, params=params, headers=HEADERS, stream=True
+        ) as response:
+            if response.status_code != 200:
+                return None
+
+            # Stop reading at the header row, it holds the report's month
+            for element in iter_aum_report(response):
+                if element.tag == "tr":
+                    cols = list(element.iter("td"))
+                    month_data = element_text(cols[-1]).split("(")[0].strip()
+
+                    return datetime.strptime(month_data, "%B %Y").date()
+
+        return None
+    except Exception as e:
+        print(f"get_report_month: {e}")
+        return None
+
+
+def insert_amcs_categories(query, amcs, categories):
+    print(f"Inserting {len(amcs)} AMCs")
+    if amcs:
+        execute_values(
+            query,
+            "INSERT INTO mutual_funds_assetmanagementcompany (code, name, slug, created_at, updated_at) VALUES %s",
+            amcs,
+        )
+    print(f"Inserting {len(categories)} Categories")
+    if categories:
+        execute_values(
+            query,
+            "INSERT INTO mutual_funds_category (code, name, slug, type, created_at, updated_at) VALUES %s",
+            categories,
+        )
+
+
+def insert_funds(query, funds, fund_names_ids_with_cats, fund_type):
+    print(f"Inserting {len(funds)} {fund_type} Funds")
+    if funds:
+        inserted_funds = execute_values(
+            query,
+            "INSERT INTO mutual_funds_fund (code, name, slug, inception_date, category_id, fund_type_id, amc_id, created_at, updated_at) VALUES %s RETURNING id, name, category_id",
+            funds,
+            fetch=True,
+        )
+
+        for row in inserted_funds:
+            index_fund(fund_names_ids_with_cats, row[0], row[1], row[2])
+
+
+def insert_mc_details(query, amcs_mc_details):
+    print(f"Inserting {len(amcs_mc_details)} AMC Market Cap Details IDs")
+    if amcs_mc_details:
+        execute_values(
+            query,
+            "INSERT INTO mutual_funds_marketcap (code, month, fund_id, created_at, updated_at) VALUES %s",
+            amcs_mc_details,
+        )
+
+
 def add_amcs_cats_funds_mc_codes(conn=None):
     try:
         query = conn.cursor()
@@ -409,12 +618,17 @@ def add_amcs_cats_funds_mc_codes(conn=None):
             "Exchange Traded Fund(ETF)",
         ]
 
+        fund_names_ids_with_cats = get_funds_names_ids(query)
+
         for tab in ("01", "02", "04", "05"):  # Fund Types Tab Indexes
             params = {"tab": tab}
 
-            response = requests.get(url=URL, params=params, headers=HEADERS)
+            with requests.get(
+                url=URL, params=params, headers=HEADERS, stream=True
+            ) as response:
+                if response.status_code != 200:
+                    continue
 
-            if response.status_code == 200:
                 amcs_ids, amcs_names, amcs_codes, amcs_slugs = get_amcs(query)
                 (
                     categories_ids,
@@ -429,24 +643,34 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                 amcs_mc_details = []
                 created_at = datetime.now(timezone.utc)
                 updated_at = created_at
+                fund_type = fund_types[int(tab) - 1]
 
-                soup = BeautifulSoup(response.content, "html.parser")
+                # AMCs and Categories are only listed as options on the first tab
+                options_pending = tab == "01"
+                count = 0
 
-                if tab == "01":
-                    options = soup.find_all("option")
+                month_date = None
+                amc_id = None
+
+                for element in iter_aum_report(response):
+                    if element.tag == "option":
+                        if not options_pending:
+                            continue
 
-                    count = 0
-                    for option in options:
-                        if option.text.strip() == "":
+                        option_text = element_text(element).strip()
+
+                        if option_text == "":
                             count += 1
-                        elif option.text.strip() == "Month":
-                            break
+                        elif option_text == "Month":
+                            options_pending = False
+                            insert_amcs_categories(query, amcs, categories)
+                            conn.commit()
                         elif count == 2:
                             pass
                         else:
-                            code = option["value"].strip()
+                            code = element.get("value", "").strip()
                             name = " ".join(
-                                option.text.strip("_")
+                                option_text.strip("_")
                                 .strip()
                                 .encode("ascii", "ignore")
                                 .decode("ascii")
@@ -495,46 +719,36 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                                             )
                                         )
 
-                    print(f"Inserting {len(amcs)} AMCs")
-                    if amcs:
-                        execute_values(
-                            query,
-                            "INSERT INTO mutual_funds_assetmanagementcompany (code, name, slug, created_at, updated_at) VALUES %s",
-                            amcs,
-                        )
-                    print(f"Inserting {len(categories)} Categories")
-                    if categories:
-                        execute_values(
-                            query,
-                            "INSERT INTO mutual_funds_category (code, name, slug, type, created_at, updated_at) VALUES %s",
-                            categories,
-                        )
-                    conn.commit()
+                        continue
 
-                amcs_ids, amcs_names, amcs_codes, amcs_slugs = get_amcs(query)
-                (
-                    categories_ids,
-                    categories_names,
-                    categories_codes,
-                    categories_slugs,
-                ) = get_categories(query)
-                existing_funds, existing_funds_slugs = get_funds(query)
-                fund_names_ids_with_cats = get_funds_names_ids(query)
-                existing_mcs = get_all_mc_codes(query)
-                table_rows = soup.find("table", {"class": "mydata"}).find_all("tr")
-                month_data = table_rows[0].find_all("td")[-1].text.split("(")[0].strip()
-                month_date = datetime.strptime(month_data, "%B %Y").isoformat()
+                    cols = list(element.iter("td"))
 
-                amc_id = None
+                    if month_date is None:  # Header Row
+                        if options_pending:
+                            options_pending = False
+                            insert_amcs_categories(query, amcs, categories)
+                            conn.commit()
+
+                        amcs_ids, amcs_names, amcs_codes, amcs_slugs = get_amcs(query)
+                        (
+                            categories_ids,
+                            categories_names,
+                            categories_codes,
+                            categories_slugs,
+                        ) = get_categories(query)
+                        existing_funds, existing_funds_slugs = get_funds(query)
+                        existing_mcs = set(get_all_mc_codes(query))
 
-                for row in table_rows[1:]:  # Skip Header Row
-                    if row.has_attr("id"):
-                        fund_code = row.get("id").strip()
-                        cols = row.find_all("td")
+                        month_data = element_text(cols[-1]).split("(")[0].strip()
+                        month_date = datetime.strptime(month_data, "%B %Y").isoformat()
+                        continue
+
+                    if element.get("id") is not None:
+                        fund_code = element.get("id").strip()
 
                         fund_name = " ".join(
-                            cols[0]
-                            .text.strip("_")
+                            element_text(cols[0])
+                            .strip("_")
                             .strip()
                             .encode("ascii", "ignore")
                             .decode("ascii")
@@ -547,8 +761,8 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                             cat_index = 1
 
                         category_name = " ".join(
-                            cols[cat_index]
-                            .text.strip("-")
+                            element_text(cols[cat_index])
+                            .strip("-")
                             .strip()
                             .encode("ascii", "ignore")
                             .decode("ascii")
@@ -558,8 +772,9 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                             categories_names.index(category_name)
                         ]
 
-                        fund_id = fund_names_ids_with_cats.get(
-                            f"{fund_name}~{category_id}", None
+                        fund_id, stored_fund_name = fund_names_ids_with_cats.get(
+                            (normalize_fund_name(fund_name), category_id),
+                            (None, None),
                         )
 
                         if fund_id and amc_id:
@@ -568,14 +783,21 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                             )
                             print(f"{fund_name} -> {fund_name_fixed}")
 
-                            if fund_name_fixed != fund_name:
+                            if fund_name_fixed != stored_fund_name:
                                 print(f"Updating Fund {fund_id}: {fund_name_fixed}")
                                 update_fund(query, fund_id, fund_name_fixed)
-                                fund_name = fund_name_fixed
+                                index_fund(
+                                    fund_names_ids_with_cats,
+                                    fund_id,
+                                    fund_name_fixed,
+                                    category_id,
+                                )
 
-                            href_text = cols[-1].find("a")
+                            fund_name = fund_name_fixed
 
-                            if href_text and href_text.get("href"):
+                            href_text = cols[-1].find(".//a")
+
+                            if href_text is not None and href_text.get("href"):
                                 amc_mc_detail_id = int(
                                     "".join(filter(str.isdigit, href_text.get("href")))
                                 )
@@ -596,7 +818,7 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                                 name=fund_name, existing_slugs=existing_funds_slugs
                             )
 
-                            inception_date = cols[cat_index + 1].text.strip()
+                            inception_date = element_text(cols[cat_index + 1]).strip()
                             if inception_date:
                                 inception_date = (
                                     datetime.strptime(inception_date, "%B %d, %Y")
@@ -619,12 +841,12 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                                     )
                                 )
                     else:
-                        if len(row.find_all("td")) > 1:
+                        if len(cols) > 1:
                             pass
                         else:
                             amc_name = " ".join(
-                                row.find("td")
-                                .text.strip("_")
+                                element_text(cols[0])
+                                .strip("_")
                                 .strip()
                                 .encode("ascii", "ignore")
                                 .decode("ascii")
@@ -637,20 +859,19 @@ def add_amcs_cats_funds_mc_codes(conn=None):
                             except Exception as e:
                                 print(f"add_amcs_cats_funds_mc_codes: {e}")
 
-                print(f"Inserting {len(funds)} {fund_types[int(tab) - 1]} Funds")
-                if funds:
-                    execute_values(
-                        query,
-                        "INSERT INTO mutual_funds_fund (code, name, slug, inception_date, category_id, fund_type_id, amc_id, created_at, updated_at) VALUES %s",
-                        funds,
-                    )
-                print(f"Inserting {len(amcs_mc_details)} AMC Market Cap Details IDs")
-                if amcs_mc_details:
-                    execute_values(
-                        query,
-                        "INSERT INTO mutual_funds_marketcap (code, month, fund_id, created_at, updated_at) VALUES %s",
-                        amcs_mc_details,
-                    )
+                    if len(funds) >= INSERT_CHUNK_SIZE:
+                        insert_funds(query, funds, fund_names_ids_with_cats, fund_type)
+                        funds = []
+                    if len(amcs_mc_details) >= INSERT_CHUNK_SIZE:
+                        insert_mc_details(query, amcs_mc_details)
+                        amcs_mc_details = []
+
+                if options_pending:
+                    insert_amcs_categories(query, amcs, categories)
+                    conn.commit()
+
+                insert_funds(query, funds, fund_names_ids_with_cats, fund_type)
+                insert_mc_details(query, amcs_mc_details)
     except Exception as e:
         print(f"add_amcs_cats_funds_mc_codes: {e}")
     finally:
@@ -678,8 +899,27 @@ def lambda_handler(event=None, context=None):
                 port=os.environ.get("DB_PORT"),
             )
 
-            add_amcs_cats_funds_mc_codes(conn)
-            add_mcs(conn)
+            query = conn.cursor()
+            event = event if isinstance(event, dict) else dict()
+            full_run = event.get("full_run") is True
+
+            scrape_funds = event.get("scrape_funds")
+            if not isinstance(scrape_funds, bool):
+                if scrape_funds is not None:
+                    print(f"Ignoring non-boolean scrape_funds: {scrape_funds!r}")
+
+                scrape_funds = full_run or is_funds_scrape_due(query)
+
+            if scrape_funds:
+                add_amcs_cats_funds_mc_codes(conn)
+            else:
+                print("No fund is due for a new month, skipping Funds", end="\n\n")
+
+            mc_codes = event.get("mc_codes")
+            if mc_codes is None and not full_run:
+                mc_codes = get_mc_codes(query, due_only=True)
+
+            add_mcs(conn, mc_codes)
 
             print(
                 "Whole Process Completed: " + datetime.now().strftime("%c %Z"),